@@ -1,25 +1,44 @@
 import os
 import sys
+import asyncio
+import json
+import pickle
+from collections import OrderedDict
+from functools import cached_property
 from operator import itemgetter
-from typing import List, Dict
+from pathlib import Path
+from typing import List, Dict, Optional
+
+import faiss
+import numpy as np
+from cachetools import TTLCache
 
 # Add the script's directory to sys.path to allow for local imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.retrievers import ContextualCompressionRetriever
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.exceptions import OutputParserException
+from langchain_core.outputs import Generation
+from langchain_core.utils.json import parse_json_markdown
 
-from config_lc import LC_FAISS_INDEX_PATH, RETRIEVAL_TOP_K, RERANK_TOP_N
-from langchain_components import QwenEmbeddings, QwenReranker, QwenLLM
+from config_lc import (
+    LC_FAISS_INDEX_PATH, RETRIEVAL_TOP_K, RETRIEVAL_BATCH_SIZE, RETRIEVAL_BATCH_WAIT_MS,
+    RERANK_TOP_N, RERANK_BATCH_SIZE, RERANK_MAX_WORKERS,
+    FAISS_HNSW_EF_SEARCH, FAISS_IVF_NPROBE, FAISS_MMAP_MIN_BYTES, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_SIZE,
+    CONVERSATION_CACHE_TTL, CONVERSATION_CACHE_MAX_SIZE
+)
+from langchain_components import QwenEmbeddings, QwenReranker, QwenLLM, BatchedFaissRetriever
 
 # --- Pydantic Models for Structured Output ---
 
@@ -32,18 +51,115 @@ class ChatResponse(BaseModel):
     thinking: str
     sources: str
 
+    @cached_property
+    def final_event(self) -> str:
+        """流式接口的最终 SSE 事件. 语义缓存命中时复用同一对象, 因此每个回答只序列化一次."""
+        return sse_event({"final_answer": self.answer, "thinking": self.thinking, "sources": self.sources})
+
+# --- 语义缓存 ---
+
+class SemanticCache:
+    """
+    基于查询向量余弦相似度的语义缓存, 命中时跳过检索、重排和 LLM 生成.
+    - embed_query 返回的向量已做 L2 归一化, 因此内积即余弦相似度.
+    - 超出容量后按 LRU 淘汰最久未被命中的条目.
+    """
+    def __init__(self, threshold: float, max_size: int):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.index = None  # 首次写入时根据向量维度创建
+        self.entries: "OrderedDict[int, ChatResponse]" = OrderedDict()
+        self.next_id = 0
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def _as_array(query_vector: List[float]) -> np.ndarray:
+        return np.asarray([query_vector], dtype=np.float32)
+
+    async def lookup(self, query_vector: List[float]) -> Optional["ChatResponse"]:
+        vector = self._as_array(query_vector)
+        async with self.lock:
+            if self.index is None or self.index.ntotal == 0:
+                return None
+            scores, ids = self.index.search(vector, 1)
+            entry_id = int(ids[0][0])
+            if entry_id < 0 or scores[0][0] < self.threshold:
+                return None
+            self.entries.move_to_end(entry_id)
+            return self.entries[entry_id]
+
+    async def add(self, query_vector: List[float], response: "ChatResponse"):
+        vector = self._as_array(query_vector)
+        async with self.lock:
+            if self.index is None:
+                self.index = faiss.IndexIDMap(faiss.IndexFlatIP(vector.shape[1]))
+            entry_id = self.next_id
+            self.next_id += 1
+            self.index.add_with_ids(vector, np.asarray([entry_id], dtype=np.int64))
+            self.entries[entry_id] = response
+            if len(self.entries) > self.max_size:
+                evicted_id, _ = self.entries.popitem(last=False)
+                self.index.remove_ids(np.asarray([evicted_id], dtype=np.int64))
+
+# --- FAISS 索引加载 ---
+
+def _is_ivf_index_file(index_file: Path) -> bool:
+    """根据文件头的 fourcc 判断是否为 IVF 索引 (如 IwFl / IwPQ / IwSq, 旧版本为 Iv 开头)"""
+    with open(index_file, "rb") as f:
+        return f.read(2) in (b"Iw", b"Iv")
+
+def load_vector_store(folder_path: Path, embeddings: QwenEmbeddings) -> FAISS:
+    """
+    加载 FAISS 向量库, 与 FAISS.load_local 读取相同的 index.faiss / index.pkl 文件.
+    - 优化: 大的 IVF 索引以只读 mmap 方式读取倒排表, 避免启动时将整个索引读入内存.
+      FAISS 的 IO_FLAG_MMAP 只对 IVF 倒排表生效, HNSW / Flat 索引仍按普通方式读入内存.
+    """
+    index_file = folder_path / "index.faiss"
+    if index_file.stat().st_size >= FAISS_MMAP_MIN_BYTES and _is_ivf_index_file(index_file):
+        try:
+            index = faiss.read_index(str(index_file), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            print("FAISS IVF 索引的倒排表已以 mmap 方式加载。")
+        except RuntimeError as e:
+            print(f"mmap 加载 FAISS 索引失败，改为读入内存。Error: {e}")
+            index = faiss.read_index(str(index_file))
+    else:
+        index = faiss.read_index(str(index_file))
+
+    # 仅加载本项目自行构建的索引文件, 其 pickle 内容可信
+    with open(folder_path / "index.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    # 按索引自身的度量选择距离策略: 新索引为内积, 旧版构建的 IndexFlatL2 仍按 L2 距离计算相关度
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
+    else:
+        distance_strategy = DistanceStrategy.EUCLIDEAN_DISTANCE
+
+    return FAISS(
+        embeddings, index, docstore, index_to_docstore_id,
+        distance_strategy=distance_strategy
+    )
+
 # --- 全局变量 ---
 rag_chain = None
+context_chain = None         # 问题 -> 检索、重排并格式化后的上下文
+generation_chain = None      # 提示词 -> LLM 原始文本输出 (支持流式)
+output_parser = None
+parse_llm_output = None
+embeddings = None
+semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_SIZE)
+# conversation_id -> (已转换的 history 条目的 (role, content) 列表, 消息对象列表)
+conversation_cache = TTLCache(maxsize=CONVERSATION_CACHE_MAX_SIZE, ttl=CONVERSATION_CACHE_TTL)
 
 # --- FastAPI 生命周期 ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global rag_chain
+    global rag_chain, context_chain, generation_chain, output_parser, parse_llm_output, embeddings
     print("--- 正在初始化 LangChain RAG 系统... ---")
 
     # 1. 初始化所有自定义组件
     embeddings = QwenEmbeddings()
-    reranker = QwenReranker(top_n=RERANK_TOP_N)
+    reranker = QwenReranker(top_n=RERANK_TOP_N, batch_size=RERANK_BATCH_SIZE, max_workers=RERANK_MAX_WORKERS)
     llm = QwenLLM()
     
     # 2. 加载 FAISS 索引
@@ -51,10 +167,18 @@ async def lifespan(app: FastAPI):
     print(f"正在从 '{faiss_path_str}' 加载 FAISS 索引...")
     if not LC_FAISS_INDEX_PATH.exists():
         raise RuntimeError(f"FAISS 索引目录不存在: {faiss_path_str}。请先运行 build_knowledge_base_lc.py")
-    vector_store = FAISS.load_local(faiss_path_str, embeddings, allow_dangerous_deserialization=True)
+    vector_store = load_vector_store(LC_FAISS_INDEX_PATH, embeddings)
+    if isinstance(vector_store.index, faiss.IndexHNSW):
+        vector_store.index.hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+    elif isinstance(vector_store.index, faiss.IndexIVF):
+        vector_store.index.nprobe = FAISS_IVF_NPROBE
 
     # 3. 创建检索器
-    base_retriever = vector_store.as_retriever(search_kwargs={"k": RETRIEVAL_TOP_K})
+    # 并发请求的向量检索在短时间窗口内合并为一次批量 search
+    base_retriever = BatchedFaissRetriever(
+        vector_store, k=RETRIEVAL_TOP_K,
+        max_batch_size=RETRIEVAL_BATCH_SIZE, max_wait_ms=RETRIEVAL_BATCH_WAIT_MS
+    )
     compression_retriever = ContextualCompressionRetriever(base_compressor=reranker, base_retriever=base_retriever)
     
     # 4. 创建用于结构化输出的解析器和提示模板 - [已优化]
@@ -72,37 +196,62 @@ async def lifespan(app: FastAPI):
 
 {format_instructions}
 
----
-**上下文:**
-{context}
----
 """
-    
+    # 启动时一次性渲染静态的指令部分 (含格式说明), 每次请求只需拼接上下文、历史和问题
+    prompt_prefix = system_prompt.format(format_instructions=parser.get_format_instructions())
+
     prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
+        ("system", "{prompt_prefix}---\n**上下文:**\n{context}\n---\n"),
         MessagesPlaceholder(variable_name="chat_history"),
         ("human", "{question}"),
-    ]).partial(format_instructions=parser.get_format_instructions())
+    ]).partial(prompt_prefix=prompt_prefix)
 
     # 5. 构建 RAG 链 (LCEL)
     def format_docs(docs: List[Dict]) -> str:
-        return "\n\n".join(f"来源: {doc.metadata.get('source', '未知')}\n内容: {doc.page_content}" for doc in docs)
+        # 来源前缀在构建知识库时已写入 metadata["_prefix"]; 兼容未包含该字段的旧索引
+        return "\n\n".join(
+            (doc.metadata.get("_prefix") or f"来源: {doc.metadata.get('source', '未知')}\n内容: ") + doc.page_content
+            for doc in docs
+        )
 
     def parse_with_fallback(output_str: str) -> dict:
+        """
+        解析模型输出. 返回值中的 "degraded" 为 True 表示输出不是完整的 JSON
+        (解析失败, 或被 LLM_MAX_NEW_TOKENS 截断后只能宽松解析), 此类回答不应写入语义缓存.
+        """
+        fallback = {
+            "thinking": "模型未能按要求生成JSON格式的回答。以下是模型的原始输出。",
+            "final_answer": str(output_str),
+            "degraded": True
+        }
+        # JsonOutputParser 会宽松地补全被截断的 JSON, 先严格解析一次判断输出是否完整
         try:
-            return parser.parse(output_str)
-        except OutputParserException as e:
-            print(f"JSON OutputParser failed. Raw output: '{output_str}'. Error: {e}")
-            return {
-                "thinking": "模型未能按要求生成JSON格式的回答。以下是模型的原始输出。",
-                "final_answer": str(output_str)
-            }
+            parsed = parse_json_markdown(output_str, parser=lambda s: json.loads(s, strict=False))
+            degraded = False
+        except ValueError:
+            try:
+                parsed = parser.parse(output_str)
+            except OutputParserException as e:
+                print(f"JSON OutputParser failed. Raw output: '{output_str}'. Error: {e}")
+                return fallback
+            print(f"模型输出的 JSON 不完整 (可能达到 LLM_MAX_NEW_TOKENS 上限). Raw output: '{output_str}'")
+            degraded = True
+        if not (isinstance(parsed, dict)
+                and isinstance(parsed.get("thinking"), str)
+                and isinstance(parsed.get("final_answer"), str)):
+            print(f"模型输出缺少 thinking/final_answer 字段. Raw output: '{output_str}'")
+            return fallback
+        return {"thinking": parsed["thinking"], "final_answer": parsed["final_answer"], "degraded": degraded}
 
-    structured_generation_chain = prompt | llm | RunnableLambda(parse_with_fallback)
+    output_parser = parser
+    parse_llm_output = parse_with_fallback
+    context_chain = itemgetter("question") | compression_retriever | RunnableLambda(format_docs)
+    generation_chain = prompt | llm
+    structured_generation_chain = generation_chain | RunnableLambda(parse_with_fallback)
 
     rag_chain = (
         {
-            "context": itemgetter("question") | compression_retriever | RunnableLambda(format_docs),
+            "context": context_chain,
             "question": itemgetter("question"),
             "chat_history": itemgetter("chat_history"),
         }
@@ -113,6 +262,7 @@ async def lifespan(app: FastAPI):
     
     print("--- LangChain RAG 系统初始化完成。 ---")
     yield
+    await base_retriever.aclose()
     print("--- 服务关闭。 ---")
 
 # --- API 定义 ---
@@ -121,6 +271,44 @@ app = FastAPI(lifespan=lifespan)
 class ChatRequest(BaseModel):
     query: str
     history: List[Dict[str, str]] = []
+    conversation_id: Optional[str] = None  # 提供时按会话缓存已转换的历史消息
+
+def build_chat_history(history: List[Dict[str, str]]) -> list:
+    chat_history_messages = []
+    for msg in history:
+        if msg.get("role") == "user":
+            chat_history_messages.append(HumanMessage(content=msg.get("content")))
+        elif msg.get("role") == "assistant":
+            chat_history_messages.append(AIMessage(content=msg.get("content")))
+    return chat_history_messages
+
+def get_chat_history(request: ChatRequest) -> list:
+    """
+    获取请求对应的历史消息对象.
+    - 提供 conversation_id 时, 只转换上次请求之后新增的 history 条目并追加到缓存的消息列表.
+    - 已转换的前缀与本次请求逐条比较 (role, content), 不一致 (历史被编辑/截断/重置) 时重新转换全部历史.
+    """
+    history = request.history
+    if request.conversation_id is None:
+        return build_chat_history(history)
+
+    consumed, messages = conversation_cache.get(request.conversation_id, ([], []))
+    if len(consumed) > len(history) or not all(
+        msg.get("role") == role and msg.get("content") == content
+        for (role, content), msg in zip(consumed, history)
+    ):
+        consumed, messages = [], []
+
+    new_history = history[len(consumed):]
+    if new_history:
+        # 不原地追加: 同一会话并发执行中的链可能仍持有缓存的消息列表
+        messages = messages + build_chat_history(new_history)
+        consumed.extend((msg.get("role"), msg.get("content")) for msg in new_history)
+    conversation_cache[request.conversation_id] = (consumed, messages)
+    return messages
+
+def sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest):
@@ -128,27 +316,90 @@ async def chat_endpoint(request: ChatRequest):
     if not rag_chain:
         raise HTTPException(status_code=503, detail="RAG chain not initialized")
 
-    chat_history_messages = []
-    for msg in request.history:
-        if msg.get("role") == "user":
-            chat_history_messages.append(HumanMessage(content=msg.get("content")))
-        elif msg.get("role") == "assistant":
-            chat_history_messages.append(AIMessage(content=msg.get("content")))
+    chat_history_messages = get_chat_history(request)
             
     input_data = {
         "question": request.query,
         "chat_history": chat_history_messages
     }
     
+    # 仅对无历史的单轮问题使用语义缓存, 避免把依赖上下文的回答错误地复用到其他对话
+    use_cache = not request.history
+
     try:
+        if use_cache:
+            query_vector = await embeddings.aembed_query(request.query)
+            cached_response = await semantic_cache.lookup(query_vector)
+            if cached_response is not None:
+                return cached_response
+
         result = await rag_chain.ainvoke(input_data)
         llm_output = result["llm_output"]
         
-        return ChatResponse(
+        response = ChatResponse(
             answer=llm_output["final_answer"],
             thinking=llm_output["thinking"],
             sources=result["context"]
         )
+        # 解析失败或被截断的回答不写入缓存, 避免一次错误生成被相似问题反复命中
+        if use_cache and not llm_output["degraded"]:
+            await semantic_cache.add(query_vector, response)
+        return response
     except Exception as e:
         print(f"处理请求时发生未预料的错误: {e}")
-        raise HTTPException(status_code=500, detail="Internal Server Error - Check logs for details.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Internal Server Error - Check logs for details.")
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    流式问答 (Server-Sent Events):
+    - 生成过程中不断发送 {"thinking_delta": ...} 事件, 内容为思考过程新增的部分.
+    - 最后发送一个 {"final_answer": ..., "thinking": ..., "sources": ...} 事件.
+    """
+    global rag_chain
+    if not rag_chain:
+        raise HTTPException(status_code=503, detail="RAG chain not initialized")
+
+    chat_history_messages = get_chat_history(request)
+    use_cache = not request.history
+
+    async def event_stream():
+        try:
+            if use_cache:
+                query_vector = await embeddings.aembed_query(request.query)
+                cached_response = await semantic_cache.lookup(query_vector)
+                if cached_response is not None:
+                    yield cached_response.final_event
+                    return
+
+            context = await context_chain.ainvoke({"question": request.query})
+
+            # 对累计的输出做增量 JSON 解析, 只发送 thinking 字段新增的部分
+            output_str = ""
+            thinking_sent = 0
+            async for chunk in generation_chain.astream({
+                "question": request.query,
+                "chat_history": chat_history_messages,
+                "context": context
+            }):
+                output_str += chunk
+                partial = output_parser.parse_result([Generation(text=output_str)], partial=True)
+                thinking = partial.get("thinking") if isinstance(partial, dict) else None
+                if isinstance(thinking, str) and len(thinking) > thinking_sent:
+                    yield sse_event({"thinking_delta": thinking[thinking_sent:]})
+                    thinking_sent = len(thinking)
+
+            llm_output = parse_llm_output(output_str)
+            response = ChatResponse(
+                answer=llm_output["final_answer"],
+                thinking=llm_output["thinking"],
+                sources=context
+            )
+            if use_cache and not llm_output["degraded"]:
+                await semantic_cache.add(query_vector, response)
+            yield response.final_event
+        except Exception as e:
+            print(f"处理流式请求时发生未预料的错误: {e}")
+            yield sse_event({"error": "Internal Server Error - Check logs for details."})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
\ No newline at end of file
@@ -1,27 +1,88 @@
 import os
 import sys
+import asyncio
+import uuid
 # Add the script's directory to sys.path to allow for local imports
 # This must be at the very top before any other local imports.
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.document_loaders import DirectoryLoader, TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
-from tqdm import tqdm
+from langchain_community.vectorstores.utils import DistanceStrategy
+from tqdm.asyncio import tqdm_asyncio
 
 from config_lc import (
     KNOWLEDGE_BASE_DIR,
     LC_FAISS_INDEX_PATH,
     CHUNK_SIZE,
     CHUNK_OVERLAP,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CONCURRENCY,
+    FAISS_INDEX_TYPE,
+    FAISS_HNSW_M,
+    FAISS_HNSW_EF_CONSTRUCTION,
+    FAISS_PQ_SUBVECTOR_DIM,
+    FAISS_PQ_NBITS,
+    FAISS_PQ_MIN_TRAIN,
+    FAISS_PQ_RECALL_SAMPLES,
+    FAISS_IVF_NPROBE,
+    RETRIEVAL_TOP_K,
 )
-from langchain_components import QwenEmbeddings
+from langchain_components import QwenEmbeddings, UringTextLoader, RegexTextSplitter
 
 
-def build_knowledge_base():
+def _report_recall(index: faiss.Index, vectors: np.ndarray):
+    """抽样部分文本块向量作为查询, 计算有损索引 top-k 相对精确内积检索的召回率"""
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(vectors), size=min(FAISS_PQ_RECALL_SAMPLES, len(vectors)), replace=False)
+    queries = vectors[sample]
+    k = min(RETRIEVAL_TOP_K, len(vectors))
+
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    _, expected_ids = exact.search(queries, k)
+    index.nprobe = FAISS_IVF_NPROBE
+    _, actual_ids = index.search(queries, k)
+
+    recall = np.mean([len(set(a) & set(e)) / k for a, e in zip(actual_ids, expected_ids)])
+    print(f"IVF-PQ recall@{k} (nprobe={FAISS_IVF_NPROBE}, 相对精确检索): {recall:.3f}")
+
+
+def _build_faiss_index(vectors: np.ndarray) -> faiss.Index:
+    """
+    根据 FAISS_INDEX_TYPE 构建索引, 替代默认的暴力检索 IndexFlatL2.
+    向量归一化后以内积作为余弦相似度.
+    """
+    faiss.normalize_L2(vectors)
+    num_vectors, dim = vectors.shape
+
+    if FAISS_INDEX_TYPE == "ivfpq":
+        if num_vectors >= FAISS_PQ_MIN_TRAIN and dim % FAISS_PQ_SUBVECTOR_DIM == 0:
+            nlist = max(1, int(np.sqrt(num_vectors)))
+            print(f"使用 IVF-PQ 索引 (nlist={nlist}, m={dim // FAISS_PQ_SUBVECTOR_DIM})...")
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFPQ(
+                quantizer, dim, nlist, dim // FAISS_PQ_SUBVECTOR_DIM, FAISS_PQ_NBITS, faiss.METRIC_INNER_PRODUCT
+            )
+            index.train(vectors)
+            index.add(vectors)
+            _report_recall(index, vectors)
+            return index
+        print(f"向量数量 ({num_vectors}) 或维度 ({dim}) 不满足 IVF-PQ 训练条件，回退到 HNSW 索引。")
+
+    index = faiss.IndexHNSWFlat(dim, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+    index.add(vectors)
+    return index
+
+
+async def abuild_knowledge_base():
     """
     使用 LangChain 构建和存储知识库
-    - 优化: 采用分批处理方式防止 GPU 显存溢出
+    - 优化: 将文本块按批并发计算 embedding, 由信号量限制同时进行的批次数
     - 修复: 增加本地模块导入路径，避免 ModuleNotFoundError
     """
     if not KNOWLEDGE_BASE_DIR.exists() or not any(KNOWLEDGE_BASE_DIR.iterdir()):
@@ -30,51 +91,67 @@ def build_knowledge_base():
 
     # 1. 加载文档
     print(f"正在从 '{KNOWLEDGE_BASE_DIR}' 加载文档...")
-    loader = DirectoryLoader(
-        str(KNOWLEDGE_BASE_DIR), # DirectoryLoader 需要字符串路径
-        glob="**/*.txt", 
-        loader_cls=TextLoader, 
-        loader_kwargs={'encoding': 'utf-8'},
-        show_progress=True,
-        use_multithreading=True
-    )
-    docs = loader.load()
+    try:
+        docs = UringTextLoader(str(KNOWLEDGE_BASE_DIR), glob="**/*.txt", encoding='utf-8').load()
+    except (ImportError, OSError) as e:
+        # io_uring 不可用 (非 Linux、内核过旧、未安装 liburing 或版本不兼容) 时回退到多线程加载
+        print(f"io_uring 加载失败，回退到 DirectoryLoader。Error: {e}")
+        loader = DirectoryLoader(
+            str(KNOWLEDGE_BASE_DIR), # DirectoryLoader 需要字符串路径
+            glob="**/*.txt", 
+            loader_cls=TextLoader, 
+            loader_kwargs={'encoding': 'utf-8'},
+            show_progress=True,
+            use_multithreading=True
+        )
+        docs = loader.load()
     print(f"文档加载完毕，共 {len(docs)} 个文件。")
 
     # 2. 文本分块
     print("正在进行文本分块...")
-    text_splitter = RecursiveCharacterTextSplitter(
+    text_splitter = RegexTextSplitter(
         chunk_size=CHUNK_SIZE,
         chunk_overlap=CHUNK_OVERLAP,
-        separators=["\n\n", "\n", "。", "！", "？", "，", "、", ""]
+        separators=["\n\n", "\n", "。", "！", "？", "，", "、"]
     )
     all_splits = text_splitter.split_documents(docs)
+    # 预先生成每个文本块在提示词上下文中的来源前缀, 避免服务端每次请求重复格式化
+    for doc in all_splits:
+        doc.metadata["_prefix"] = f"来源: {doc.metadata.get('source', '未知')}\n内容: "
     print(f"文本分块完成，共生成 {len(all_splits)} 个文本块。")
 
     # 3. 初始化 Embedding 模型
     print("初始化自定义 Embedding 模型...")
     embeddings = QwenEmbeddings()
     
-    # 4. 分批构建 FAISS 索引以节省显存
-    print("正在分批构建 FAISS 索引并存储...")
-    
-    # 根据你的显存大小调整此值，32 是一个比较安全的大小
-    BATCH_SIZE = 32 
-    
-    # 使用第一个批次来初始化 FAISS 数据库
-    first_batch = all_splits[:BATCH_SIZE]
-    if not first_batch:
+    # 4. 批量计算 embedding 并一次性构建 FAISS 索引
+    if not all_splits:
         print("没有可处理的文本块，程序退出。")
         return
-        
-    print(f"正在处理第 1 批 (共 {len(all_splits) // BATCH_SIZE + 1} 批)...")
-    db = FAISS.from_documents(first_batch, embeddings)
-    
-    # 循环处理剩余的批次，并添加到现有数据库中
-    for i in tqdm(range(BATCH_SIZE, len(all_splits), BATCH_SIZE), desc="Adding documents to FAISS"):
-        batch = all_splits[i:i + BATCH_SIZE]
-        if batch:
-            db.add_documents(batch)
+
+    print("正在并发计算文本块的 embedding...")
+    texts = [doc.page_content for doc in all_splits]
+
+    sem = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+    async def _emb(batch):
+        async with sem:
+            return await embeddings.aembed_documents(batch)
+
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    results = await tqdm_asyncio.gather(*[_emb(b) for b in batches], desc="Embedding batches")
+    vectors = [vector for batch_vectors in results for vector in batch_vectors]
+
+    print("正在构建 FAISS 索引并存储...")
+    index = _build_faiss_index(np.asarray(vectors, dtype=np.float32))
+    doc_ids = [str(uuid.uuid4()) for _ in all_splits]
+    db = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(doc_ids, all_splits))),
+        index_to_docstore_id=dict(enumerate(doc_ids)),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
 
     # 5. 保存最终的索引文件
     # 确保目标目录存在
@@ -85,4 +162,4 @@ def build_knowledge_base():
     print(f"FAISS 索引已保存至: {LC_FAISS_INDEX_PATH}")
 
 if __name__ == '__main__':
-    build_knowledge_base()
\ No newline at end of file
+    asyncio.run(abuild_knowledge_base())
\ No newline at end of file
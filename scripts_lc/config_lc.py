@@ -33,22 +33,81 @@ RERANKER_MODEL_PATH = MODEL_REPO_PATH / RERANKER_MODEL_NAME
 LLM_MODEL_PATH = MODEL_REPO_PATH / LLM_MODEL_NAME
 
 
+# --- 文档加载配置 ---
+URING_QUEUE_DEPTH = 128  # io_uring 单次批量提交的读请求数量 (Linux)
+
+
 # --- RAG 参数配置 ---
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 100
 RETRIEVAL_TOP_K = 20  # 检索器初步检索的文档数量
+RETRIEVAL_BATCH_SIZE = 32       # 合并为一次 FAISS 检索的最大并发查询数
+RETRIEVAL_BATCH_WAIT_MS = 5.0   # 收集并发查询的最长等待时间 (毫秒)
 RERANK_TOP_N = 5      # Reranker 模型重排后保留的文档数量
+# Reranker 打分批次: 默认全部候选文档一次前向完成. 单卡推理时拆成多个并发批次只会增加
+# kernel 启动和 GIL 竞争, 仅在多卡或 HTTP 推理后端时才调小 batch size 并增大 worker 数
+RERANK_BATCH_SIZE = RETRIEVAL_TOP_K  # 每个打分批次包含的文档数量
+RERANK_MAX_WORKERS = 1               # 并发打分的最大批次数
+
+
+# --- FAISS 索引配置 (内积度量) ---
+# 索引类型: "hnsw" 为 HNSW 图索引 (保留原始向量), "ivfpq" 为倒排 + 乘积量化 (有损压缩, 节省内存和带宽)
+# ivfpq 会降低召回率, 构建时会打印相对精确检索的 recall, 确认可接受后再启用
+FAISS_INDEX_TYPE = "hnsw"
+
+# HNSW 参数
+FAISS_HNSW_M = 32                 # 每个节点的邻居数
+FAISS_HNSW_EF_CONSTRUCTION = 200  # 构建时的候选队列长度, 越大图质量越高、构建越慢
+FAISS_HNSW_EF_SEARCH = 64         # 检索时的候选队列长度, 需不小于 RETRIEVAL_TOP_K
+
+# IVF-PQ 参数 (nlist 取 sqrt(N), 子量化器数量取 dim / FAISS_PQ_SUBVECTOR_DIM)
+FAISS_PQ_SUBVECTOR_DIM = 8  # 每个子量化器负责的维度数
+FAISS_PQ_NBITS = 8          # 每个子量化器的编码位数
+FAISS_PQ_MIN_TRAIN = 39 * 2 ** FAISS_PQ_NBITS  # 按 FAISS 建议每个码本中心至少 39 个训练点, 不足时回退到 HNSW
+FAISS_PQ_RECALL_SAMPLES = 100  # 构建后评估 recall 时抽样的查询数量
+FAISS_IVF_NPROBE = 16       # 检索时访问的倒排桶数量
+
+# IVF 索引文件不小于该大小时以内存映射 (mmap) 方式加载倒排表, 按需从磁盘读取页面; 小索引直接读入内存
+FAISS_MMAP_MIN_BYTES = 5 * 1024 * 1024
+
+
+# --- 语义缓存配置 ---
+SEMANTIC_CACHE_THRESHOLD = 0.87  # 查询向量余弦相似度不低于该值时直接返回缓存的回答
+SEMANTIC_CACHE_MAX_SIZE = 1024   # 缓存条目上限, 超出后按 LRU 淘汰
+
+
+# --- 会话历史缓存配置 ---
+CONVERSATION_CACHE_TTL = 30 * 60      # 会话消息列表的缓存时间 (秒)
+CONVERSATION_CACHE_MAX_SIZE = 10000   # 同时缓存的会话数量上限
 
 
 # --- 模型超参数 ---
 # 注意：这些值应与你使用的模型能力相匹配
 EMBEDDING_MAX_LENGTH = 8192
+EMBEDDING_BATCH_SIZE = 64   # Embedding 模型单次前向的文本数量, 显存不足时调小
+QUERY_EMBEDDING_CACHE_SIZE = 4096  # 查询 embedding 精确匹配 LRU 缓存的条目上限
+
+
+# --- Embedding 推理后端配置 ---
+# "local": 在本进程内用 transformers 加载模型; "infinity": 通过 HTTP 调用 Infinity 推理服务
+EMBEDDING_BACKEND = "local"
+INFINITY_API_URL = "http://localhost:7997"
+INFINITY_MODEL_NAME = "Qwen/Qwen3-Embedding-4B"  # 需与 Infinity 服务启动时的 --model-id 一致
+INFINITY_BATCH_SIZE = 256        # 单次 POST /embeddings 请求包含的文本数量
+INFINITY_MAX_CONNECTIONS = 64    # HTTP 连接池上限
+INFINITY_TIMEOUT = 120.0         # 单次请求超时时间 (秒)
+
+# 构建知识库时并发执行的 embedding 批次数: 本地单卡推理不宜过大, 远程服务可提高并发以重叠网络往返
+EMBEDDING_CONCURRENCY = 8 if EMBEDDING_BACKEND == "infinity" else 2
 RERANKER_MAX_LENGTH = 8192  # 根据官方示例, Reranker 的 max_length 也是 8192
 LLM_MAX_NEW_TOKENS = 512
+LLM_STREAM_TIMEOUT = 60.0  # 流式生成时等待下一段文本的最长时间 (秒), 超时即中止生成
 
 
 # --- 设备配置 ---
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# Embedding 模型推理精度: GPU 上使用 fp16 (可改为 torch.bfloat16 以获得更大数值范围), CPU 上 fp16 算子较慢, 使用 fp32
+EMBEDDING_DTYPE = torch.float16 if DEVICE == "cuda" else torch.float32
 
 
 # --- 检查路径是否存在 (可选，但推荐) ---
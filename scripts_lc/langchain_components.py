@@ -1,18 +1,46 @@
+import asyncio
+import hashlib
+import os
+import re
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Event, Lock, Thread
+import httpx
+import numpy as np
 import torch
 import torch.nn.functional as F
+from numba import njit
 from torch import Tensor
-from transformers import AutoModel, AutoTokenizer, AutoModelForCausalLM
-from typing import List, Any, Dict, Optional
+from transformers import (
+    AutoModel, AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+)
+from typing import List, Any, AsyncIterator, Dict, Iterator, Optional
+
+try:
+    import liburing  # 仅 Linux 可用, 缺失时由调用方回退到 DirectoryLoader
+except ImportError:
+    liburing = None
 
+from langchain_core.document_loaders import BaseLoader
 from langchain_core.embeddings import Embeddings
 from langchain_core.language_models.llms import LLM
-from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun, AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForLLMRun, CallbackManagerForRetrieverRun
+)
+from langchain_core.outputs import GenerationChunk
+from langchain_core.retrievers import BaseRetriever
 from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
 from langchain_core.documents import Document
+from langchain_text_splitters import TextSplitter
 
 from config_lc import (
-    EMBEDDING_MODEL_PATH, RERANKER_MODEL_PATH, LLM_MODEL_PATH, DEVICE,
-    EMBEDDING_MAX_LENGTH, RERANKER_MAX_LENGTH, LLM_MAX_NEW_TOKENS
+    EMBEDDING_MODEL_PATH, RERANKER_MODEL_PATH, LLM_MODEL_PATH, DEVICE, EMBEDDING_DTYPE,
+    EMBEDDING_MAX_LENGTH, EMBEDDING_BATCH_SIZE, RERANKER_MAX_LENGTH, LLM_MAX_NEW_TOKENS, LLM_STREAM_TIMEOUT,
+    EMBEDDING_BACKEND, INFINITY_API_URL, INFINITY_MODEL_NAME, INFINITY_BATCH_SIZE,
+    INFINITY_MAX_CONNECTIONS, INFINITY_TIMEOUT, URING_QUEUE_DEPTH, QUERY_EMBEDDING_CACHE_SIZE
 )
 
 # --- 辅助函数 ---
@@ -28,72 +56,214 @@ def _last_token_pool(last_hidden_states: Tensor, attention_mask: Tensor) -> Tens
         batch_size = last_hidden_states.shape[0]
         return last_hidden_states[torch.arange(batch_size, device=last_hidden_states.device), sequence_lengths]
 
+@njit(cache=True, fastmath=True)
+def _normalize_1d(vector: np.ndarray) -> np.ndarray:
+    """
+    对单个 float32 向量原地做 L2 归一化 (查询路径专用), 返回同一个数组.
+    - 只接受 1-D 输入, 避免 numba 对动态维度的类型推断错误.
+    """
+    norm_sq = 0.0
+    for i in range(vector.shape[0]):
+        norm_sq += vector[i] * vector[i]
+    if norm_sq == 0.0:
+        return vector
+    inv_norm = 1.0 / np.sqrt(norm_sq)
+    for i in range(vector.shape[0]):
+        vector[i] *= inv_norm
+    return vector
+
+class _EventStoppingCriteria(StoppingCriteria):
+    """stop_event 被设置后 (如客户端断开) 让 generate 在下一个 token 处停止"""
+    def __init__(self, stop_event: Event):
+        self.stop_event = stop_event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.stop_event.is_set(), dtype=torch.bool, device=input_ids.device)
+
 # 1. 自定义 Embedding 组件
 class QwenEmbeddings(Embeddings):
     """
     封装 Qwen Embedding 模型.
+    - 支持两种后端: 本地 transformers 推理, 或通过 HTTP 调用 Infinity 推理服务 (EMBEDDING_BACKEND).
+    - 查询 embedding 带有按原始查询文本精确匹配的 LRU 缓存, 重复查询无需再次推理.
     """
     model: Any = None
     tokenizer: Any = None
+    http_client: Any = None
+    async_http_client: Any = None
+    query_cache: Any = None
+    query_cache_lock: Any = None
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.query_cache = OrderedDict()
+        self.query_cache_lock = Lock()
+        if EMBEDDING_BACKEND == "infinity":
+            print(f"使用 Infinity 推理服务: {INFINITY_API_URL} (模型: {INFINITY_MODEL_NAME})")
+            limits = httpx.Limits(max_connections=INFINITY_MAX_CONNECTIONS)
+            self.http_client = httpx.Client(base_url=INFINITY_API_URL, limits=limits, timeout=INFINITY_TIMEOUT)
+            self.async_http_client = httpx.AsyncClient(
+                base_url=INFINITY_API_URL, http2=True, limits=limits, timeout=INFINITY_TIMEOUT
+            )
+            return
+
         print("正在加载 Embedding 模型...")
         # 优化: 根据官方示例, 增加 padding_side='left'
         self.tokenizer = AutoTokenizer.from_pretrained(
             EMBEDDING_MODEL_PATH, trust_remote_code=True, padding_side='left'
         )
         self.model = AutoModel.from_pretrained(
-            EMBEDDING_MODEL_PATH, trust_remote_code=True, torch_dtype=torch.float16
+            EMBEDDING_MODEL_PATH, trust_remote_code=True, torch_dtype=EMBEDDING_DTYPE
         ).to(DEVICE).eval()
         print("Embedding 模型加载成功。")
 
     def _get_instruct(self, task_description: str, query: str) -> str:
         # 与官方示例 `get_detailed_instruct` 函数对齐
         return f'Instruct: {task_description}\nQuery: {query}'
-    
-    def _embed(self, texts: List[str]) -> List[List[float]]:
-        with torch.no_grad():
-            batch_dict = self.tokenizer(
-                texts, padding=True, truncation=True, 
-                max_length=EMBEDDING_MAX_LENGTH, return_tensors="pt"
+
+    def _query_text(self, text: str) -> str:
+        # 对于查询，官方建议添加 instruction
+        task = "Given a web search query, retrieve relevant passages that answer the query"
+        return self._get_instruct(task, text)
+
+    @staticmethod
+    def _query_cache_key(text: str) -> bytes:
+        # 使用定长摘要作为键, 避免缓存长查询原文占用内存
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _query_cache_get(self, key: bytes) -> Optional[List[float]]:
+        with self.query_cache_lock:
+            embedding = self.query_cache.get(key)
+            if embedding is not None:
+                self.query_cache.move_to_end(key)
+            return embedding
+
+    def _query_cache_put(self, key: bytes, embedding: List[float]):
+        with self.query_cache_lock:
+            self.query_cache[key] = embedding
+            self.query_cache.move_to_end(key)
+            if len(self.query_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+                self.query_cache.popitem(last=False)
+
+    @staticmethod
+    def _parse_remote(response: httpx.Response) -> List[List[float]]:
+        response.raise_for_status()
+        data = sorted(response.json()["data"], key=lambda item: item["index"])
+        return [item["embedding"] for item in data]
+
+    def _embed_remote(self, texts: List[str]) -> List[List[float]]:
+        results = []
+        for start in range(0, len(texts), INFINITY_BATCH_SIZE):
+            response = self.http_client.post(
+                "/embeddings", json={"model": INFINITY_MODEL_NAME, "input": texts[start:start + INFINITY_BATCH_SIZE]}
             )
-            batch_dict = {k: v.to(DEVICE) for k, v in batch_dict.items()}
-            outputs = self.model(**batch_dict)
-            embeddings = _last_token_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
-            normalized_embeddings = F.normalize(embeddings, p=2, dim=1)
-            return normalized_embeddings.cpu().tolist()
+            results.extend(self._parse_remote(response))
+        return results
+
+    async def _aembed_remote(self, texts: List[str]) -> List[List[float]]:
+        async def _post(batch: List[str]) -> List[List[float]]:
+            response = await self.async_http_client.post(
+                "/embeddings", json={"model": INFINITY_MODEL_NAME, "input": batch}
+            )
+            return self._parse_remote(response)
+
+        batches = [texts[i:i + INFINITY_BATCH_SIZE] for i in range(0, len(texts), INFINITY_BATCH_SIZE)]
+        results = await asyncio.gather(*[_post(batch) for batch in batches])
+        return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def _embed_local(self, texts: List[str], normalize: bool = True) -> np.ndarray:
+        # 按 EMBEDDING_BATCH_SIZE 在内部切分, 调用方可一次性传入全部文本; 返回 (n, dim) 的 float32 数组
+        results = []
+        autocast = torch.autocast(device_type=DEVICE, dtype=EMBEDDING_DTYPE, enabled=DEVICE == "cuda")
+        with torch.inference_mode(), autocast:
+            for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+                batch_dict = self.tokenizer(
+                    texts[start:start + EMBEDDING_BATCH_SIZE], padding=True, truncation=True,
+                    max_length=EMBEDDING_MAX_LENGTH, return_tensors="pt"
+                )
+                batch_dict = {k: v.to(DEVICE) for k, v in batch_dict.items()}
+                outputs = self.model(**batch_dict)
+                # 半精度推理, 池化结果转为 fp32 后再归一化以保证余弦相似度精度
+                embeddings = _last_token_pool(outputs.last_hidden_state, batch_dict['attention_mask']).float()
+                if normalize:
+                    embeddings = F.normalize(embeddings, p=2, dim=1)
+                results.append(embeddings.cpu().numpy())
+        return results[0] if len(results) == 1 else np.concatenate(results)
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        if self.http_client is not None:
+            return self._embed_remote(texts)
+        return self._embed_local(texts).tolist()
+
+    async def _aembed(self, texts: List[str]) -> List[List[float]]:
+        if self.async_http_client is not None:
+            return await self._aembed_remote(texts)
+        # 本地推理在线程中执行以免阻塞事件循环
+        return await asyncio.to_thread(self._embed, texts)
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """计算文档的 embedding (用于知识库构建)"""
         # 对于文档，官方建议不加 instruction
         return self._embed(texts)
 
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """异步计算文档的 embedding"""
+        return await self._aembed(texts)
+
     def embed_query(self, text: str) -> List[float]:
         """计算查询的 embedding (用于检索)"""
-        # 对于查询，官方建议添加 instruction
-        task = "Given a web search query, retrieve relevant passages that answer the query"
-        instructed_text = self._get_instruct(task, text)
-        embedding = self._embed([instructed_text])
-        return embedding[0]
+        key = self._query_cache_key(text)
+        cached = self._query_cache_get(key)
+        if cached is not None:
+            return cached
+        # 单条查询全程保持 float32 数组, 在 CPU 上用 numba 内核原地归一化, 最后只转换一次为 list
+        if self.http_client is not None:
+            vector = np.asarray(self._embed_remote([self._query_text(text)])[0], dtype=np.float32)
+        else:
+            vector = self._embed_local([self._query_text(text)], normalize=False)[0]
+        embedding = _normalize_1d(vector).tolist()
+        self._query_cache_put(key, embedding)
+        return embedding
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """异步计算查询的 embedding"""
+        key = self._query_cache_key(text)
+        cached = self._query_cache_get(key)
+        if cached is not None:
+            return cached
+        if self.async_http_client is not None:
+            vector = np.asarray((await self._aembed_remote([self._query_text(text)]))[0], dtype=np.float32)
+        else:
+            vector = (await asyncio.to_thread(self._embed_local, [self._query_text(text)], False))[0]
+        embedding = _normalize_1d(vector).tolist()
+        self._query_cache_put(key, embedding)
+        return embedding
 
 # 2. 自定义 Reranker 组件 (根据官方示例优化)
 class QwenReranker(BaseDocumentCompressor):
     """
     封装 Qwen Reranker 模型.
     - 优化: 完全对齐官方示例的 prompt 模板和 tokenization 逻辑.
+    - 默认所有候选文档在一次前向中打分; 多卡或远程后端时可按 batch_size 切分, 由最多 max_workers 个线程并发打分.
     """
     model: Any = None
     tokenizer: Any = None
     top_n: int = 5
+    batch_size: int = 20
+    max_workers: int = 1
+    executor: Any = None
     token_false_id: int = 0
     token_true_id: int = 0
     prefix_tokens: List[int] = None
     suffix_tokens: List[int] = None
 
-    def __init__(self, top_n: int, **kwargs):
+    def __init__(self, top_n: int, batch_size: int = 20, max_workers: int = 1, **kwargs):
         super().__init__(**kwargs)
         self.top_n = top_n
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        if max_workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers)
         print("正在加载 Reranker 模型...")
         self.tokenizer = AutoTokenizer.from_pretrained(
             RERANKER_MODEL_PATH, trust_remote_code=True, padding_side='left'
@@ -116,11 +286,8 @@ class QwenReranker(BaseDocumentCompressor):
     def _format_instruction(self, instruction, query, doc):
         return f"<Instruct>: {instruction}\n<Query>: {query}\n<Document>: {doc}"
 
-    def compress_documents(self, documents: List[Document], query: str, callbacks=None) -> List[Document]:
-        """使用 Reranker 模型对检索到的文档进行排序和筛选"""
-        if not documents:
-            return []
-        
+    def _score(self, query: str, documents: List[Document]) -> List[float]:
+        """计算一个批次内每个文档与查询的相关性分数"""
         instruction = 'Given a web search query, retrieve relevant passages that answer the query'
         pairs = [self._format_instruction(instruction, query, doc.page_content) for doc in documents]
         
@@ -146,8 +313,26 @@ class QwenReranker(BaseDocumentCompressor):
             # 使用 log_softmax 和 exp 计算概率
             stacked_scores = torch.stack([false_vector, true_vector], dim=1)
             log_probs = torch.nn.functional.log_softmax(stacked_scores, dim=1)
-            scores = log_probs[:, 1].exp().cpu().tolist()
-        
+            return log_probs[:, 1].exp().cpu().tolist()
+
+    def _safe_score(self, query: str, documents: List[Document]) -> List[float]:
+        """
+        批次打分失败时逐个文档重新打分, 仅对单独仍然失败的文档赋予中性分数 0.5,
+        避免一个异常文档拖累同批次其他文档的排序.
+        """
+        try:
+            return self._score(query, documents)
+        except Exception as e:
+            if len(documents) == 1:
+                print(f"Reranker 打分失败, 使用默认分数 0.5。Error: {e}")
+                return [0.5]
+            print(f"Reranker 批次打分失败, 改为逐个文档打分。Error: {e}")
+            return [score for doc in documents for score in self._safe_score(query, [doc])]
+
+    def _split_batches(self, documents: List[Document]) -> List[List[Document]]:
+        return [documents[i:i + self.batch_size] for i in range(0, len(documents), self.batch_size)]
+
+    def _select_top(self, documents: List[Document], scores: List[float]) -> List[Document]:
         # 将分数添加到文档元数据中，并排序
         for doc, score in zip(documents, scores):
             doc.metadata['rerank_score'] = score
@@ -155,6 +340,35 @@ class QwenReranker(BaseDocumentCompressor):
         sorted_docs = sorted(documents, key=lambda x: x.metadata['rerank_score'], reverse=True)
         return sorted_docs[:self.top_n]
 
+    def compress_documents(self, documents: List[Document], query: str, callbacks=None) -> List[Document]:
+        """使用 Reranker 模型对检索到的文档进行排序和筛选"""
+        if not documents:
+            return []
+        
+        batches = self._split_batches(documents)
+        if self.executor is not None and len(batches) > 1:
+            batch_scores = list(self.executor.map(lambda batch: self._safe_score(query, batch), batches))
+        else:
+            batch_scores = [self._safe_score(query, batch) for batch in batches]
+
+        scores = [score for scores_of_batch in batch_scores for score in scores_of_batch]
+        return self._select_top(documents, scores)
+
+    async def acompress_documents(self, documents: List[Document], query: str, callbacks=None) -> List[Document]:
+        """异步版本: 在线程中打分 (多批次时并发), 不阻塞事件循环"""
+        if not documents:
+            return []
+
+        sem = asyncio.Semaphore(max(1, self.max_workers))
+
+        async def _score_batch(batch):
+            async with sem:
+                return await asyncio.to_thread(self._safe_score, query, batch)
+
+        batch_scores = await asyncio.gather(*[_score_batch(batch) for batch in self._split_batches(documents)])
+        scores = [score for scores_of_batch in batch_scores for score in scores_of_batch]
+        return self._select_top(documents, scores)
+
 
 # 3. 自定义 LLM 组件
 class QwenLLM(LLM):
@@ -198,4 +412,304 @@ class QwenLLM(LLM):
         response_ids = generated_ids[0][input_len:]
         
         response = self.tokenizer.decode(response_ids, skip_special_tokens=True)
-        return response
\ No newline at end of file
+        return response
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        stop_event: Optional[Event] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        """
+        流式生成: 在后台线程中执行 generate, 通过 TextIteratorStreamer 逐段产出文本.
+        - 迭代结束、超时或被关闭时设置 stop_event, 让后台 generate 尽快停止, 不再占用 GPU.
+        """
+        stop_event = stop_event or Event()
+        model_inputs = self.tokenizer([prompt], return_tensors="pt").to(DEVICE)
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=LLM_STREAM_TIMEOUT
+        )
+
+        thread = Thread(target=self.model.generate, kwargs=dict(
+            input_ids=model_inputs.input_ids,
+            max_new_tokens=LLM_MAX_NEW_TOKENS,
+            attention_mask=model_inputs.attention_mask,
+            pad_token_id=self.tokenizer.eos_token_id,
+            streamer=streamer,
+            stopping_criteria=StoppingCriteriaList([_EventStoppingCriteria(stop_event)])
+        ))
+        thread.start()
+        try:
+            for text in streamer:
+                if not text:
+                    continue
+                chunk = GenerationChunk(text=text)
+                if run_manager:
+                    run_manager.on_llm_new_token(text, chunk=chunk)
+                yield chunk
+        finally:
+            stop_event.set()
+            thread.join()
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        """
+        异步流式生成: 在线程中逐段读取 _stream 的结果.
+        - 请求被取消 (如 SSE 客户端断开) 时设置 stop_event, 中止后台生成.
+        - 结束时在线程中显式关闭 _stream 生成器, 由它 join 生成线程, 避免生成器被回收时在事件循环线程上阻塞.
+        """
+        stop_event = Event()
+        iterator = self._stream(
+            prompt, stop, run_manager.get_sync() if run_manager else None, stop_event=stop_event, **kwargs
+        )
+        # 取消时线程中的 next() 可能仍在执行, close() 需等它返回, 否则会抛出 "generator already executing"
+        iterator_lock = Lock()
+        done = object()
+
+        def _next():
+            with iterator_lock:
+                return next(iterator, done)
+
+        def _close():
+            with iterator_lock:
+                iterator.close()
+
+        try:
+            while True:
+                chunk = await asyncio.to_thread(_next)
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            stop_event.set()
+            # shield: 再次被取消时关闭操作仍会在线程中完成
+            await asyncio.shield(asyncio.to_thread(_close))
+
+
+# 4. 自定义文档加载器
+class UringTextLoader(BaseLoader):
+    """
+    使用 io_uring 批量读取目录下的文本文件.
+    - 每批最多提交 queue_depth 个读请求, 一次 submit_and_wait 完成, 减少系统调用和线程切换.
+    - 按 liburing 2026.x 的 API 编写 (Ring/Cqe, io_uring_prep_read 按 len(buf) 读取), 版本见 requirements_lc.txt.
+    - io_uring 不可用时 (未安装 liburing、版本不兼容或内核不支持) 抛出 ImportError / OSError, 由调用方回退.
+    """
+    # 旧版 liburing (如 2024.x) 没有 Ring/Cqe, 且 io_uring_prep_read 的第四个参数是 nbytes 而非 offset
+    _REQUIRED_API = ("Ring", "Cqe", "trap_error", "io_uring_sqe_set_data64", "io_uring_prep_read")
+
+    def __init__(self, path: str, glob: str = "**/*.txt", encoding: str = "utf-8", queue_depth: int = URING_QUEUE_DEPTH):
+        self.path = Path(path)
+        self.glob = glob
+        self.encoding = encoding
+        self.queue_depth = queue_depth
+
+    def _decode(self, buf: bytearray) -> str:
+        # 与 TextLoader 以文本模式 open() 读取的结果保持一致 (统一换行符)
+        return buf.decode(self.encoding).replace("\r\n", "\n").replace("\r", "\n")
+
+    def _read_batch(self, ring: Any, cqe: Any, paths: List[Path]) -> List[bytearray]:
+        fds = []
+        try:
+            for path in paths:
+                fds.append(os.open(path, os.O_RDONLY))
+            bufs = [bytearray(os.fstat(fd).st_size) for fd in fds]
+            for i, (fd, buf) in enumerate(zip(fds, bufs)):
+                sqe = liburing.io_uring_get_sqe(ring)
+                # 读取长度取自 len(buf), offset 以关键字传入避免与旧 API 的 nbytes 混淆
+                liburing.io_uring_prep_read(sqe, fd, buf, offset=0)
+                liburing.io_uring_sqe_set_data64(sqe, i)
+            liburing.io_uring_submit_and_wait(ring, len(fds))
+
+            sizes = [0] * len(fds)
+            for _ in range(len(fds)):
+                liburing.io_uring_wait_cqe(ring, cqe)
+                entry = cqe[0]
+                i = entry.user_data
+                res = entry.res
+                liburing.io_uring_cqe_seen(ring, entry)
+                sizes[i] = liburing.trap_error(res)
+
+            # 处理短读: 剩余部分用普通 pread 补齐; 记录下来, 避免 io_uring 实际未读取数据而被静默掩盖
+            short = [i for i, buf in enumerate(bufs) if sizes[i] < len(buf)]
+            if short:
+                print(f"io_uring 短读 {len(short)}/{len(fds)} 个文件, 剩余部分改用 pread 读取。")
+            for i, (fd, buf) in enumerate(zip(fds, bufs)):
+                while sizes[i] < len(buf):
+                    chunk = os.pread(fd, len(buf) - sizes[i], sizes[i])
+                    if not chunk:
+                        del buf[sizes[i]:]
+                        break
+                    buf[sizes[i]:sizes[i] + len(chunk)] = chunk
+                    sizes[i] += len(chunk)
+            return bufs
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def lazy_load(self) -> Iterator[Document]:
+        if liburing is None:
+            raise ImportError("未安装 liburing, 无法使用 io_uring 读取文件")
+        missing = [name for name in self._REQUIRED_API if not hasattr(liburing, name)]
+        if missing:
+            raise ImportError(f"liburing 版本不兼容 (缺少 {', '.join(missing)}), 请安装 requirements_lc.txt 中固定的版本")
+
+        paths = sorted(p for p in self.path.glob(self.glob) if p.is_file())
+        ring = liburing.Ring()
+        cqe = liburing.Cqe()
+        liburing.io_uring_queue_init(self.queue_depth, ring)
+        try:
+            for start in range(0, len(paths), self.queue_depth):
+                batch = paths[start:start + self.queue_depth]
+                for path, buf in zip(batch, self._read_batch(ring, cqe, batch)):
+                    yield Document(page_content=self._decode(buf), metadata={"source": str(path)})
+        finally:
+            liburing.io_uring_queue_exit(ring)
+
+
+# 5. 自定义文本分块器
+class RegexTextSplitter(TextSplitter):
+    """
+    基于预编译正则的文本分块器, 替代 RecursiveCharacterTextSplitter.
+    - 所有分隔符合并为一个正则, 单次扫描得到全部可切分位置 (分隔符保留在前一块末尾).
+    - 每个文本块用二分查找定位不超过 chunk_size 的最远切分位置, 找不到时按长度硬切分.
+    - 下一块从不早于 `上一块结尾 - chunk_overlap` 的最近切分位置开始, 以保留重叠.
+    """
+    def __init__(self, separators: List[str], **kwargs: Any):
+        super().__init__(**kwargs)
+        self._separator_re = re.compile("|".join(re.escape(sep) for sep in separators if sep))
+
+    def split_text(self, text: str) -> List[str]:
+        text_len = len(text)
+        boundaries = [m.end() for m in self._separator_re.finditer(text)]
+        if not boundaries or boundaries[-1] != text_len:
+            boundaries.append(text_len)
+
+        chunks = []
+        start = 0
+        while start < text_len:
+            i = bisect_right(boundaries, start + self._chunk_size) - 1
+            end = boundaries[i] if i >= 0 and boundaries[i] > start else min(start + self._chunk_size, text_len)
+            chunks.append(text[start:end])
+            if end >= text_len:
+                break
+            j = bisect_left(boundaries, max(end - self._chunk_overlap, start + 1))
+            start = boundaries[j] if j < len(boundaries) and boundaries[j] < end else end
+
+        if self._strip_whitespace:
+            chunks = [chunk.strip() for chunk in chunks]
+        return [chunk for chunk in chunks if chunk]
+
+# 6. 自定义批量检索器
+class BatchedFaissRetriever(BaseRetriever):
+    """
+    将并发请求的查询向量合并为一次 FAISS 批量检索.
+    - 异步检索时把 (查询向量, future) 放入队列, 后台任务在 max_wait_ms 内最多收集 max_batch_size 个查询,
+      拼成 (B, d) 矩阵后调用一次 index.search, 再把每一行结果分发给对应的 future.
+    - 同步检索直接单条查询.
+    """
+    vector_store: Any = None
+    k: int = 4
+    max_batch_size: int = 32
+    max_wait_ms: float = 5.0
+    queue: Any = None
+    worker: Any = None
+    worker_loop: Any = None
+
+    def __init__(self, vector_store: Any, k: int, max_batch_size: int = 32, max_wait_ms: float = 5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.vector_store = vector_store
+        self.k = k
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+    def _docs_from_ids(self, ids: np.ndarray) -> List[Document]:
+        docs = []
+        for i in ids:
+            if i == -1:
+                continue  # 结果不足 k 个时 FAISS 以 -1 填充
+            doc_id = self.vector_store.index_to_docstore_id[int(i)]
+            doc = self.vector_store.docstore.search(doc_id)
+            if not isinstance(doc, Document):
+                raise ValueError(f"Could not find document for id {doc_id}, got {doc}")
+            docs.append(doc)
+        return docs
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        vector = np.asarray([self.vector_store.embeddings.embed_query(query)], dtype=np.float32)
+        _, ids = self.vector_store.index.search(vector, self.k)
+        return self._docs_from_ids(ids[0])
+
+    def _ensure_worker(self):
+        # 队列只在事件循环变化时重建; 后台任务退出后在同一个队列上重启, 不丢弃正在等待的请求
+        loop = asyncio.get_running_loop()
+        if self.worker_loop is not loop:
+            self.queue = asyncio.Queue()
+            self.worker = None
+            self.worker_loop = loop
+        if self.worker is None or self.worker.done():
+            self.worker = loop.create_task(self._batch_worker())
+
+    @staticmethod
+    def _fail_batch(batch: list, error: BaseException):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _batch_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            try:
+                batch.append(await self.queue.get())
+                deadline = loop.time() + self.max_wait_ms / 1000
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                vectors = np.asarray([vector for vector, _ in batch], dtype=np.float32)
+                _, ids = await asyncio.to_thread(self.vector_store.index.search, vectors, self.k)
+                for row, (_, future) in zip(ids, batch):
+                    if not future.done():  # 请求可能已被取消
+                        future.set_result(row)
+            except asyncio.CancelledError:
+                self._fail_batch(batch, RuntimeError("检索器已关闭"))
+                raise
+            except Exception as e:
+                # 任何异常都只让当前批次的请求失败, 后台任务继续处理后续请求
+                self._fail_batch(batch, e)
+
+    async def aclose(self):
+        """停止后台批处理任务, 并让队列中尚未处理的请求失败 (服务关闭时调用)"""
+        if self.worker is not None and not self.worker.done():
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.worker = None
+        if self.queue is not None:
+            pending = []
+            while not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+            self._fail_batch(pending, RuntimeError("检索器已关闭"))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector = await self.vector_store.embeddings.aembed_query(query)
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((vector, future))
+        return self._docs_from_ids(await future)